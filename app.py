@@ -1,33 +1,84 @@
 import streamlit as st
-import google.generativeai as genai
 import os
 import redis
-import json
+import orjson
 import uuid
-from datetime import datetime, timedelta
+import hashlib
+import re
+import time
+import atexit
+import logging
+import queue
+import threading
+from datetime import date, datetime, timedelta
+from functools import lru_cache
 
 # --- Configuration ---
 try:
     api_key = st.secrets["API_KEY"]
-    genai.configure(api_key=api_key)
 except (KeyError, FileNotFoundError):
     st.error("Gemini API key not found. Please set it as a Streamlit secret.")
     st.stop()
 
 # --- Redis Configuration ---
+@st.cache_resource
+def get_redis_client(redis_url):
+    """Creates a Redis client backed by a shared, bounded connection pool"""
+    pool = redis.BlockingConnectionPool.from_url(
+        redis_url,
+        max_connections=50,
+        timeout=5,
+        decode_responses=True,
+        socket_keepalive=True,
+        # A half-open connection must not hang the shared write worker
+        socket_connect_timeout=5,
+        socket_timeout=5
+    )
+    client = redis.Redis(connection_pool=pool)
+    # Checked once per process since the client is cached across reruns
+    client.ping()
+    return client
+
 try:
     redis_url = st.secrets["REDIS_URL"]
-    redis_client = redis.from_url(redis_url, decode_responses=True)
-    redis_client.ping()
-    st.success("Connected to Redis!")
+    redis_client = get_redis_client(redis_url)
 except Exception as e:
     st.error(f"Could not connect to Redis: {e}")
     st.info("Please ensure REDIS_URL is correctly set in your Streamlit secrets.")
     st.stop()
 
 # --- Constants ---
-CHAT_SESSIONS_KEY = "teachpy:chat_sessions"
+SESSIONS_BY_TIME_KEY = "teachpy:sessions_by_time"
+SESSIONS_BY_ACTIVITY_KEY = "teachpy:sessions_by_activity"  # Scored by last write or view, for pruning
+LEGACY_CHAT_SESSIONS_KEY = "teachpy:chat_sessions"  # Pre-list schema, migrated on startup
 CURRENT_SESSION_KEY = "teachpy:current_session"
+SESSION_MESSAGES_KEY = "teachpy:session:{session_id}:msgs"
+SESSION_META_KEY = "teachpy:session:{session_id}:meta"
+SIDEBAR_SESSION_LIMIT = 50
+SESSION_TTL = 7 * 24 * 60 * 60  # Abandoned sessions expire after a week
+CHAT_HISTORY_WINDOW = 20  # Recent messages sent to the model verbatim
+CHAT_MODEL = "gemini-2.0-flash"
+CACHED_CHAT_MODEL = "gemini-2.0-flash-001"  # Context caching needs a pinned model version
+SUMMARY_MODEL = "gemini-2.0-flash-lite"
+PERSONA_CACHE_TTL = timedelta(hours=1)
+PERSONA_CACHE_MIN_TOKENS = 4096  # Smallest prompt Gemini accepts for context caching
+WRITE_BATCH_SIZE = 32  # Queued writes applied per MULTI/EXEC
+WRITE_FLUSH_TIMEOUT = 5  # Seconds to wait for queued writes before reading anyway
+
+# Response cache for the first turn of a session
+RESPONSE_CACHE_KEY = "teachpy:respcache:{digest}"
+RESPONSE_CACHE_TTL = 300  # Seconds
+
+APP_CSS = """
+<style>
+body {
+    font-size: 15px;
+}
+.sidebar .sidebar-content {
+    width: 300px;
+}
+</style>
+"""
 
 PERSONA_INSTRUCTION = """
 You are an expert Python teacher chatbot named "TeachPy". Your sole focus is to teach Python.
@@ -70,23 +121,169 @@ To guide learners from beginner to advanced levels in a structured, step-by-step
 """
 
 # --- Model Initialization ---
+@st.cache_resource
+def get_genai():
+    """Imports and configures the Gemini SDK on first use, keeping it out of cold start"""
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+    return genai
+
 def get_gemini_model():
-    return genai.GenerativeModel(
-        model_name="gemini-2.0-flash",
+    """Returns the shared model; chat sessions carry their own state and are not cached"""
+    if persona_is_cacheable():
+        model = get_cached_persona_model()
+        if model is not None:
+            return model
+    return get_inline_persona_model()
+
+@st.cache_resource
+def get_inline_persona_model():
+    """Returns the model with the persona sent inline as its system instruction"""
+    return get_genai().GenerativeModel(
+        model_name=CHAT_MODEL,
         system_instruction=PERSONA_INSTRUCTION
     )
 
+@st.cache_resource
+def persona_is_cacheable():
+    """Checks once per process whether the persona is long enough for context caching"""
+    # A token covers at least one character, so a shorter persona can never
+    # qualify; this avoids a count_tokens call on the first turn
+    if len(PERSONA_INSTRUCTION) < PERSONA_CACHE_MIN_TOKENS:
+        return False
+
+    from google.api_core.exceptions import GoogleAPIError
+    try:
+        model = get_genai().GenerativeModel(model_name=CACHED_CHAT_MODEL)
+        token_count = model.count_tokens(PERSONA_INSTRUCTION).total_tokens
+    except GoogleAPIError:
+        logging.exception("Failed to count persona tokens, sending the persona inline")
+        return False
+    return token_count >= PERSONA_CACHE_MIN_TOKENS
+
+# Rebuilt shortly before the cached persona expires on Gemini's side
+@st.cache_resource(ttl=PERSONA_CACHE_TTL - timedelta(minutes=5))
+def get_cached_persona_model():
+    """Returns a model referencing the persona through context caching, or None if that fails"""
+    from google.api_core.exceptions import GoogleAPIError
+    genai = get_genai()
+    try:
+        cached_persona = genai.caching.CachedContent.create(
+            model=CACHED_CHAT_MODEL,
+            system_instruction=PERSONA_INSTRUCTION,
+            ttl=PERSONA_CACHE_TTL
+        )
+    except GoogleAPIError:
+        logging.exception("Failed to cache the persona, sending it inline")
+        return None
+    return genai.GenerativeModel.from_cached_content(cached_persona)
+
+@st.cache_resource
+def get_summary_model():
+    """Returns the cheaper model used to summarize older conversation turns"""
+    return get_genai().GenerativeModel(model_name=SUMMARY_MODEL)
+
+# --- Response Cache ---
+def is_cacheable_turn(messages):
+    """Checks whether a turn is free of conversation context and can be shared between learners"""
+    # Later answers depend on the learner's version, level and roadmap, so only
+    # the reply to the fixed welcome message is cached
+    return not any(message["role"] == "user" for message in messages)
+
+def get_response_cache_key(prompt):
+    """Returns the cache key for a prompt, ignoring case, punctuation and spacing"""
+    # Matched exactly: replies to "Python 3, beginner" and "Python 2, beginner"
+    # differ although the prompts are nearly identical
+    normalized_prompt = " ".join(re.findall(r"\w+(?:\.\w+)*", prompt.lower()))
+    return RESPONSE_CACHE_KEY.format(digest=hashlib.sha256(normalized_prompt.encode()).hexdigest())
+
+def find_cached_response(prompt):
+    """Returns the prompt's cache key and any cached response; failures fall through to generation"""
+    cache_key = get_response_cache_key(prompt)
+    try:
+        return cache_key, redis_client.get(cache_key)
+    except redis.RedisError:
+        logging.exception("Response cache lookup failed, generating a response instead")
+        return cache_key, None
+
+def cache_response(cache_key, response_text):
+    """Stores a response in the response cache for a limited time"""
+    try:
+        redis_client.set(cache_key, response_text, ex=RESPONSE_CACHE_TTL)
+    except redis.RedisError:
+        logging.exception("Failed to store a response in the response cache")
+
+# --- Background Writes ---
+def run_write_worker(write_queue):
+    """Applies queued Redis writes in pipelined batches"""
+    while True:
+        batch = [write_queue.get()]
+        while len(batch) < WRITE_BATCH_SIZE:
+            try:
+                batch.append(write_queue.get_nowait())
+            except queue.Empty:
+                break
+        # Flush markers are events, set once every write queued before them is applied
+        writes = [item for item in batch if not isinstance(item, threading.Event)]
+        try:
+            if writes:
+                with redis_client.pipeline() as pipe:
+                    for write in writes:
+                        write(pipe)
+                    results = pipe.execute(raise_on_error=False)
+                # Commands in a MULTI/EXEC fail individually; the rest are still applied
+                errors = [result for result in results if isinstance(result, Exception)]
+                if errors:
+                    logging.error("%d of %d queued Redis commands failed, first error: %s",
+                                  len(errors), len(results), errors[0])
+        except Exception:
+            logging.exception("Failed to apply %d queued Redis writes", len(writes))
+        finally:
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+                write_queue.task_done()
+
+@st.cache_resource
+def get_write_queue():
+    """Returns the process-wide write queue, starting its worker thread once"""
+    write_queue = queue.Queue()
+    threading.Thread(target=run_write_worker, args=(write_queue,), daemon=True).start()
+    # Best effort: apply whatever is still queued when the process exits
+    atexit.register(wait_for_writes, write_queue)
+    return write_queue
+
+def queue_write(write):
+    """Queues a write, a callable taking a pipeline, off the request's critical path"""
+    get_write_queue().put(write)
+
+def wait_for_writes(write_queue):
+    """Waits, for a bounded time, until the writes queued so far have been applied"""
+    # Writes queued later, e.g. by other users, are not waited for
+    marker = threading.Event()
+    write_queue.put(marker)
+    if not marker.wait(timeout=WRITE_FLUSH_TIMEOUT):
+        logging.warning("Queued Redis writes not applied after %ds, continuing", WRITE_FLUSH_TIMEOUT)
+
+def flush_writes():
+    """Blocks until the writes queued so far have been applied, so reads see them"""
+    wait_for_writes(get_write_queue())
+
 # --- Chat Session Management ---
 
 #To change the date from YYYY-MM-DD to a more readable format (to name of the day)
-def format_chat_timestamp(timestamp_str):
+def format_chat_timestamp(timestamp_str, today=None):
     """Convert timestamp string to relative day format"""
-    # Parse the timestamp string
-    timestamp = datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M")
-    now = datetime.now()
+    # Callers formatting many timestamps, like the sidebar, compute today once and pass it in
+    return format_chat_day(timestamp_str, today or date.today())
+
+@lru_cache(maxsize=1024)
+def format_chat_day(timestamp_str, today):
+    """Convert timestamp string to a day name relative to the given date"""
+    # Parse the ISO 8601 timestamp string
+    timestamp = datetime.fromisoformat(timestamp_str)
     
     # Calculate time differences
-    today = now.date()
     yesterday = today - timedelta(days=1)
     timestamp_date = timestamp.date()
     
@@ -97,108 +294,292 @@ def format_chat_timestamp(timestamp_str):
     else:
         # Return day name (Monday, Tuesday, etc.)
         return timestamp.strftime("%A")
+
+def get_messages_key(session_id):
+    """Returns the Redis list key holding a session's messages"""
+    return SESSION_MESSAGES_KEY.format(session_id=session_id)
+
+def get_meta_key(session_id):
+    """Returns the Redis hash key holding a session's metadata"""
+    return SESSION_META_KEY.format(session_id=session_id)
+
 # In your session creation code:
 def create_new_session():
     """Creates a new chat session with a unique ID"""
     session_id = str(uuid.uuid4())
     # In your session creation code:
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M")  # Keep this for storage
-    display_time = format_chat_timestamp(timestamp)  # Use this for display
+    timestamp = datetime.now().isoformat(timespec="minutes")  # Keep this for storage
 
-    session_data = {
-        "id": session_id,
-        "title": f"New Session ({display_time})",  # Use the formatted time here
-        "messages": [],
-        "created_at": timestamp,  # Keep original timestamp
-        "display_time": display_time  # Store formatted version too
-    }
-    
-    # Store the new session in Redis
-    redis_client.hset(CHAT_SESSIONS_KEY, session_id, json.dumps(session_data))
-    redis_client.set(CURRENT_SESSION_KEY, session_id)
-    
     # Add initial welcome message
     initial_message = {
         "role": "assistant",
         "content": "Hello! I am TeachPy. To get started, could you please tell me which version of Python you'd like to learn (Python 2 or Python 3) and what you would consider your current skill level: *Beginner*, *Intermediate*, or *Advanced*?"
     }
-    add_message_to_session(session_id, initial_message)
+
+    # Only small metadata lives in the meta hash; messages go to their own list.
+    # The title is set by the first user message, see add_message_to_session;
+    # until then the sidebar labels the session by its creation day
+    session_meta = {
+        "created_at": timestamp,  # Keep original timestamp
+        "message_count": 1  # The welcome message
+    }
+    
+    # Store the new session and its welcome message in Redis
+    with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hset(get_meta_key(session_id), mapping=session_meta)
+        pipe.rpush(get_messages_key(session_id), orjson.dumps(initial_message))
+        pipe.expire(get_meta_key(session_id), SESSION_TTL)
+        pipe.expire(get_messages_key(session_id), SESSION_TTL)
+        pipe.zadd(SESSIONS_BY_TIME_KEY, {session_id: time.time()})
+        pipe.zadd(SESSIONS_BY_ACTIVITY_KEY, {session_id: time.time()})
+        pipe.set(CURRENT_SESSION_KEY, session_id)
+        pipe.execute()
     
     return session_id
 
-def get_current_session():
-    """Gets or creates the current session"""
-    session_id = redis_client.get(CURRENT_SESSION_KEY)
-    if not session_id:
-        return create_new_session()
-    return session_id
+@st.cache_resource
+def migrate_legacy_sessions():
+    """Moves sessions from the old single-hash schema into per-session keys, once"""
+    migrating_key = f"{LEGACY_CHAT_SESSIONS_KEY}:migrating"
+    try:
+        # Atomic, so only one process starts the migration
+        redis_client.rename(LEGACY_CHAT_SESSIONS_KEY, migrating_key)
+    except redis.ResponseError:
+        # Nothing new to migrate; resume an earlier run that did not finish
+        if not redis_client.exists(migrating_key):
+            return
+
+    # Each migrated session is removed from migrating_key in the same transaction,
+    # so an interrupted run resumes with the sessions it had not finished yet
+    for session_id, session_data in redis_client.hgetall(migrating_key).items():
+        try:
+            session = orjson.loads(session_data)
+            messages = session["messages"]
+            created_at = datetime.fromisoformat(session["created_at"])
+            session_meta = {
+                "created_at": session["created_at"],
+                "message_count": len(messages)
+            }
+            # Sessions without a user message still carry the default title
+            if len(messages) > 1:
+                session_meta["title"] = session["title"]
+
+            with redis_client.pipeline() as pipe:
+                pipe.delete(get_meta_key(session_id), get_messages_key(session_id))
+                pipe.hset(get_meta_key(session_id), mapping=session_meta)
+                if messages:
+                    pipe.rpush(get_messages_key(session_id), *(orjson.dumps(m) for m in messages))
+                pipe.expire(get_meta_key(session_id), SESSION_TTL)
+                pipe.expire(get_messages_key(session_id), SESSION_TTL)
+                pipe.zadd(SESSIONS_BY_TIME_KEY, {session_id: created_at.timestamp()})
+                # The TTL starts now, so activity does too
+                pipe.zadd(SESSIONS_BY_ACTIVITY_KEY, {session_id: time.time()})
+                pipe.hdel(migrating_key, session_id)
+                pipe.execute()
+        except Exception:
+            # Left in migrating_key for the next run; the hash is deleted once empty
+            logging.exception("Failed to migrate legacy session %s", session_id)
 
 def get_session_messages(session_id):
     """Retrieves messages for a specific session"""
-    session_data = redis_client.hget(CHAT_SESSIONS_KEY, session_id)
-    if session_data:
-        return json.loads(session_data)["messages"]
-    return []
+    flush_writes()
+    return [orjson.loads(m) for m in redis_client.lrange(get_messages_key(session_id), 0, -1)]
+
+def get_history_summary(session_id, older_messages):
+    """Returns a summary of the older messages, extending the stored one when needed"""
+    summary, summary_count = redis_client.hmget(get_meta_key(session_id), "summary", "summary_count")
+    summary_count = int(summary_count or 0)
+    if summary and summary_count == len(older_messages):
+        return summary
+
+    # Only the messages not yet covered by the stored summary are sent
+    if summary_count > len(older_messages):
+        summary, summary_count = None, 0
+    transcript = "\n\n".join(
+        f"{'TeachPy' if message['role'] == 'assistant' else 'Learner'}: {message['content']}"
+        for message in older_messages[summary_count:]
+    )
+    prompt = (
+        "Summarize this Python tutoring conversation so the tutor can continue it. "
+        "Keep the learner's Python version, skill level, agreed roadmap, topics covered "
+        "and the current topic.\n\n"
+        f"Previous summary:\n{summary or 'None'}\n\nConversation:\n{transcript}"
+    )
+    summary = get_summary_model().generate_content(prompt).text
+    redis_client.hset(get_meta_key(session_id), mapping={
+        "summary": summary,
+        "summary_count": len(older_messages)
+    })
+    return summary
+
+def start_chat_session(session_id, messages=None):
+    """Starts a Gemini chat seeded with a session's stored messages"""
+    if messages is None:
+        messages = get_session_messages(session_id)
+
+    # Send the recent window verbatim and fold older messages into a summary,
+    # which is only regenerated once per CHAT_HISTORY_WINDOW new messages
+    history = []
+    summarized = (max(len(messages) - CHAT_HISTORY_WINDOW, 0) // CHAT_HISTORY_WINDOW) * CHAT_HISTORY_WINDOW
+    if summarized:
+        try:
+            summary = get_history_summary(session_id, messages[:summarized])
+        except Exception:
+            # Keep the history bounded even without a summary of the older turns
+            logging.exception("Failed to summarize older messages of session %s", session_id)
+            summary = None
+        if summary:
+            history.append({"role": "user", "parts": [f"Summary of our earlier conversation:\n{summary}"]})
+            if messages[summarized]["role"] == "user":
+                history.append({"role": "model", "parts": ["Got it, let's continue from there."]})
+
+    history.extend(
+        {"role": "model" if message["role"] == "assistant" else message["role"], "parts": [message["content"]]}
+        for message in messages[summarized:]
+    )
+    return get_gemini_model().start_chat(history=history)
 
 def add_message_to_session(session_id, message):
     """Adds a message to a specific session"""
-    session_data = redis_client.hget(CHAT_SESSIONS_KEY, session_id)
-    if session_data:
-        session = json.loads(session_data)
-        session["messages"].append(message)
-        # Update the session title if it's the first user message
-        if message["role"] == "user" and len(session["messages"]) == 2:
-            session["title"] = f"{message['content'][:30]}..."
-        redis_client.hset(CHAT_SESSIONS_KEY, session_id, json.dumps(session))
-
-def get_all_sessions():
-    """Retrieves all chat sessions"""
+    payload = orjson.dumps(message)
+
+    def write(pipe):
+        pipe.rpush(get_messages_key(session_id), payload)
+        pipe.hincrby(get_meta_key(session_id), "message_count", 1)
+        # Set the session title from the first user message
+        if message["role"] == "user":
+            pipe.hsetnx(get_meta_key(session_id), "title", f"{message['content'][:30]}...")
+        pipe.expire(get_messages_key(session_id), SESSION_TTL)
+        pipe.expire(get_meta_key(session_id), SESSION_TTL)
+        pipe.zadd(SESSIONS_BY_ACTIVITY_KEY, {session_id: time.time()})
+
+    queue_write(write)
+
+def remove_last_message(session_id):
+    """Removes the most recent message from a specific session"""
+    def write(pipe):
+        pipe.rpop(get_messages_key(session_id))
+        pipe.hincrby(get_meta_key(session_id), "message_count", -1)
+
+    queue_write(write)
+
+@st.cache_resource
+def backfill_session_activity():
+    """Gives sessions indexed before activity tracking an activity score, once"""
+    # Creation time is a lower bound on last activity; prune_expired_sessions
+    # checks the keys before removing anything, so an early candidate is harmless
+    redis_client.zunionstore(
+        SESSIONS_BY_ACTIVITY_KEY,
+        [SESSIONS_BY_ACTIVITY_KEY, SESSIONS_BY_TIME_KEY],
+        aggregate="MAX"
+    )
+
+def prune_expired_sessions(session_ids):
+    """Removes sessions whose keys have expired from the session indexes"""
+    with redis_client.pipeline(transaction=False) as pipe:
+        for session_id in session_ids:
+            pipe.exists(get_meta_key(session_id))
+        alive = pipe.execute()
+
+    expired_session_ids = [sid for sid, exists in zip(session_ids, alive) if not exists]
+    with redis_client.pipeline(transaction=False) as pipe:
+        if expired_session_ids:
+            pipe.zrem(SESSIONS_BY_TIME_KEY, *expired_session_ids)
+            pipe.zrem(SESSIONS_BY_ACTIVITY_KEY, *expired_session_ids)
+        # Still alive, so their activity score was stale; check again a TTL from now
+        for session_id, exists in zip(session_ids, alive):
+            if exists:
+                pipe.zadd(SESSIONS_BY_ACTIVITY_KEY, {session_id: time.time()})
+        pipe.execute()
+
+def load_ui_state():
+    """Loads the current session, the sidebar sessions and the current messages in two round-trips"""
+    migrate_legacy_sessions()
+    backfill_session_activity()
+    flush_writes()
+    # Session IDs come back newest first, scored by creation time
+    with redis_client.pipeline(transaction=False) as pipe:
+        pipe.get(CURRENT_SESSION_KEY)
+        pipe.zrevrange(SESSIONS_BY_TIME_KEY, 0, SIDEBAR_SESSION_LIMIT - 1)
+        pipe.zrangebyscore(SESSIONS_BY_ACTIVITY_KEY, "-inf", time.time() - SESSION_TTL)
+        current_session_id, session_ids, inactive_session_ids = pipe.execute()
+
+    if inactive_session_ids:
+        prune_expired_sessions(inactive_session_ids)
+
+    if not current_session_id:
+        current_session_id = create_new_session()
+        session_ids = [current_session_id, *session_ids][:SIDEBAR_SESSION_LIMIT]
+
+    # Fetch only the small metadata fields plus the current session's messages
+    with redis_client.pipeline(transaction=False) as pipe:
+        for session_id in session_ids:
+            pipe.hmget(get_meta_key(session_id), "title", "created_at", "message_count")
+        pipe.hget(get_meta_key(current_session_id), "created_at")
+        pipe.lrange(get_messages_key(current_session_id), 0, -1)
+        # Refresh the expiry of the session being viewed
+        pipe.expire(get_messages_key(current_session_id), SESSION_TTL)
+        pipe.expire(get_meta_key(current_session_id), SESSION_TTL)
+        pipe.zadd(SESSIONS_BY_ACTIVITY_KEY, {current_session_id: time.time()}, xx=True)
+        *results, current_created_at, raw_messages, _, _, _ = pipe.execute()
+
+    # The current session expired or was never migrated; start a fresh one
+    # rather than writing into keys the sidebar no longer knows about
+    if current_created_at is None:
+        create_new_session()
+        return load_ui_state()
+
+    # Day labels are relative to today, so compute it once per render
+    today = date.today()
     sessions = []
-    for session_id, session_data in redis_client.hgetall(CHAT_SESSIONS_KEY).items():
-        session = json.loads(session_data)
+    expired_session_ids = []
+    for session_id, (title, created_at, message_count) in zip(session_ids, results):
+        if created_at is None:
+            expired_session_ids.append(session_id)
+            continue
         sessions.append({
             "id": session_id,
-            "title": session["title"],
-            "created_at": session["created_at"],
-            "message_count": len(session["messages"])
+            "title": title or f"New Session ({format_chat_timestamp(created_at, today)})",
+            "created_at": created_at,
+            "message_count": int(message_count or 0)
         })
-    # Sort sessions by creation date (newest first)
-    return sorted(sessions, key=lambda x: x["created_at"], reverse=True)
+    if expired_session_ids:
+        with redis_client.pipeline(transaction=False) as pipe:
+            pipe.zrem(SESSIONS_BY_TIME_KEY, *expired_session_ids)
+            pipe.zrem(SESSIONS_BY_ACTIVITY_KEY, *expired_session_ids)
+            pipe.execute()
+    messages = [orjson.loads(m) for m in raw_messages]
+    return current_session_id, sessions, messages
 
 def delete_session(session_id):
     """Deletes a chat session"""
-    redis_client.hdel(CHAT_SESSIONS_KEY, session_id)
+    # Queued writes would otherwise recreate the deleted keys
+    flush_writes()
+    redis_client.zrem(SESSIONS_BY_TIME_KEY, session_id)
+    redis_client.zrem(SESSIONS_BY_ACTIVITY_KEY, session_id)
+    redis_client.delete(get_meta_key(session_id), get_messages_key(session_id))
     current_session = redis_client.get(CURRENT_SESSION_KEY)
     if current_session and current_session == session_id:
         redis_client.delete(CURRENT_SESSION_KEY)
 
 # --- Streamlit App ---
 def main():
-    st.markdown(
-    """
-    <style>
-    body {
-        font-size: 15px;
-    }
-    .sidebar .sidebar-content {
-        width: 300px;
-    }
-    """,
-    unsafe_allow_html=True
-    )
-
+    # Page config must be the first Streamlit call
     st.set_page_config(
         page_title="TeachPy",
         page_icon="🐍",
         layout="wide"
     )
+    st.markdown(APP_CSS, unsafe_allow_html=True)
 
-    # Initialize session state
-    if "chat_session" not in st.session_state:
-        st.session_state.chat_session = get_gemini_model().start_chat(history=[])
+    # Get or create current session, along with the sidebar and its messages
+    current_session_id, sessions, messages = load_ui_state()
 
-    # Get or create current session
-    current_session_id = get_current_session()
+    # The Gemini chat is started lazily, when the first message is sent. It is also
+    # reset when the session changed outside this script run, e.g. after it expired
+    # and load_ui_state replaced it, so a new session never inherits old history
+    if current_session_id != st.session_state.get("current_session_id"):
+        st.session_state.chat_session = None
     st.session_state.current_session_id = current_session_id
 
     # --- Sidebar ---
@@ -209,13 +590,12 @@ def main():
         if st.button("➕ New Chat", use_container_width=True):
             current_session_id = create_new_session()
             st.session_state.current_session_id = current_session_id
-            st.session_state.chat_session = get_gemini_model().start_chat(history=[])
+            st.session_state.chat_session = None
             st.rerun()
         
         st.divider()
         
         # List of all chat sessions
-        sessions = get_all_sessions()
         if sessions:
             st.subheader("Previous Chats")
             for session in sessions:
@@ -226,7 +606,7 @@ def main():
                         if session['id'] == current_session_id:
                             current_session_id = create_new_session()
                             st.session_state.current_session_id = current_session_id
-                            st.session_state.chat_session = get_gemini_model().start_chat(history=[])
+                            st.session_state.chat_session = None
                         st.rerun()
                 with cols[1]:
                     if st.button(session["title"], key=session["id"], use_container_width=True):
@@ -234,16 +614,13 @@ def main():
                             current_session_id = session["id"]
                             st.session_state.current_session_id = current_session_id
                             redis_client.set(CURRENT_SESSION_KEY, current_session_id)
-                            st.session_state.chat_session = get_gemini_model().start_chat(history=[])
+                            st.session_state.chat_session = None
                             st.rerun()
 
     # --- Main Chat Area ---
     st.title("🐍 TeachPy: Your Personal Python Tutor")
     st.write("Welcome! I'm here to help you master Python, one step at a time.")
 
-    # Load messages for current session
-    messages = get_session_messages(current_session_id)
-    
     # Display chat messages
     for message in messages:
         with st.chat_message(message["role"]):
@@ -260,28 +637,83 @@ def main():
         with st.chat_message("user"):
             st.markdown(user_prompt)
 
-        # Get model response
+        response_saved = False
         try:
-            with st.spinner("TeachPy is thinking..."):
-                response = st.session_state.chat_session.send_message(user_prompt)
-                response_text = response.text
-                
-                # Add assistant response to session
-                assistant_message = {"role": "assistant", "content": response_text}
-                add_message_to_session(current_session_id, assistant_message)
-                
+            if st.session_state.chat_session is None:
+                st.session_state.chat_session = start_chat_session(current_session_id, messages)
+            elif st.session_state.chat_session.model is not get_gemini_model():
+                # The model was rebuilt with a fresh persona cache; carry the history over
+                st.session_state.chat_session = get_gemini_model().start_chat(
+                    history=st.session_state.chat_session.history
+                )
+
+            # Answer from the cache when the same question was asked recently
+            cache_key = None
+            response_text = None
+            if is_cacheable_turn(messages):
+                cache_key, response_text = find_cached_response(user_prompt)
+            cached = response_text is not None
+
+            if cached:
                 with st.chat_message("assistant"):
                     st.markdown(response_text)
+                # Keep the model's history in step with the cached turn
+                chat_session = st.session_state.chat_session
+                chat_session.history = [
+                    *chat_session.history,
+                    {"role": "user", "parts": [user_prompt]},
+                    {"role": "model", "parts": [response_text]}
+                ]
+            else:
+                # Stream the model response as it is generated
+                response = st.session_state.chat_session.send_message(user_prompt, stream=True)
+
+                def stream_response_text():
+                    for chunk in response:
+                        # Chunks without content (e.g. the final one of a blocked reply) have no text
+                        if chunk.candidates and chunk.candidates[0].content.parts:
+                            yield chunk.text
+
+                with st.chat_message("assistant"):
+                    response_text = st.write_stream(stream_response_text)
+                # Reading the history raises BrokenResponseError if the reply stopped for
+                # SAFETY, RECITATION, etc. (assigned so Streamlit magic does not render it)
+                _ = st.session_state.chat_session.history
+
+                # Usage metadata is complete once the stream has been consumed
+                usage = response.usage_metadata
+                logging.info(
+                    "Gemini usage for session %s: %d prompt, %d response, %d total tokens",
+                    current_session_id,
+                    usage.prompt_token_count,
+                    usage.candidates_token_count,
+                    usage.total_token_count
+                )
+
+            # Add the full assistant response to session once streaming completes
+            assistant_message = {"role": "assistant", "content": response_text}
+            add_message_to_session(current_session_id, assistant_message)
+            response_saved = True
+
+            if cache_key is not None and not cached:
+                cache_response(cache_key, response_text)
 
         except Exception as e:
             st.error(f"An error occurred: {e}")
             # Remove the last user message if the API call failed
-            session_data = redis_client.hget(CHAT_SESSIONS_KEY, current_session_id)
-            if session_data:
-                session = json.loads(session_data)
-                if session["messages"] and session["messages"][-1]["role"] == "user":
-                    session["messages"].pop()
-                    redis_client.hset(CHAT_SESSIONS_KEY, current_session_id, json.dumps(session))
+            if not response_saved:
+                remove_last_message(current_session_id)
+                # A broken streamed reply poisons the chat's history; rebuild it from Redis next turn
+                st.session_state.chat_session = None
+
+        # Rebuild the chat once its history outgrows the window so older turns get summarized.
+        # The reply is already shown and saved, so a failure here is only logged
+        chat_session = st.session_state.chat_session
+        if chat_session is not None and len(chat_session.history) > 2 * CHAT_HISTORY_WINDOW + 1:
+            try:
+                st.session_state.chat_session = start_chat_session(current_session_id)
+            except Exception:
+                logging.exception("Failed to rebuild the chat history of session %s", current_session_id)
 
     
 